@@ -1,108 +1,254 @@
-from multiprocessing import Process, Pool
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import argparse
 import csv
+import hashlib
 import json
+import mmap
 import os
 import re
 import subprocess
+import tempfile
 import zipfile
 
 import numpy
 import scipy.optimize
+import scipy.sparse
+import scipy.sparse.csgraph
 
+try:
+    # optional, LAPJV is faster than scipy for large dense assignment problems
+    import lap
+except ImportError:
+    lap = None
 
-TRACE_VERSION_RE = re.compile(r"VERSION: ([0-9]+)")
-TRACE_NUM_RE = re.compile(r"Threads \(([0-9]+)\):")
-TRACE_ITEM_RE = re.compile(r"([0-9]+)[ \t]+(ent|xit|unr)(!*)[ \t]+([0-9]+)[ \-\+]([^ \t]+)[ \t]+([^ \t]+)[ \t]+([^ \t]+)")
+try:
+    # optional, faster JSON encoding of comparison results
+    import orjson
+except ImportError:
+    orjson = None
 
 
-def trace_str_to_class_method(trace_str):
-    trace_idx = len("ent ")
-    while not trace_str[trace_idx].isalpha():
-        trace_idx += 1
-    return trace_str[trace_idx:]
+# lap.lapjv has a higher fixed overhead than linear_sum_assignment and only
+# pays off from about this many threads on a side
+LAPJV_MIN_SIZE = 64
 
+# dumps are parsed as bytes, names and methods are decoded leniently since
+# they may contain bytes that are not valid in the encoding
+TRACE_ENCODING = "utf-8"
 
-def clean_trace(trace_list, ex_package_set):
+TRACE_VERSION_RE = re.compile(rb"VERSION: ([0-9]+)")
+TRACE_NUM_RE = re.compile(rb"Threads \(([0-9]+)\):")
+TRACE_ITEM_RE = re.compile(rb"([0-9]+)[ \t]+(ent|xit|unr)(!*)[ \t]+([0-9]+)[ \-\+]"
+                           rb"([^A-Za-z \t\r\n]*)([^ \t\r\n]+)[ \t]+([^ \t\r\n]+)[ \t]+([^ \t\r\n]+)")
+
+
+def decode_trace_field(field):
+    return field.decode(TRACE_ENCODING, "replace")
+
+
+def trace_item_to_str(trace_item):
+    # trace items are kept as raw (action, "!"s, depth, method, signature, file)
+    return decode_trace_field(b"%s%s %s%s %s %s" % trace_item)
+
+
+def class_method_irrelevant(class_method, ex_package_set):
+    # whether any package prefix of the method's class is irrelevant
+    trimmed_trace_str = class_method.split("$")[0]
+
+    trace_segments = trimmed_trace_str.split(".")
+    for idx, trace_segment in enumerate(trace_segments):
+        if trace_segment.find(" ") >= 0:
+            break
+        elif ".".join(trace_segments[:idx + 1]) in ex_package_set:
+            return True
+    return False
+
+
+def clean_trace(trace_list, class_method_list, ex_package_set):
     # Clean irrelevant traces like java.lang, android.view
     # return trace_list, origin_idx_list
     ret_trace_list = []
     origin_idx_list = []
-    for trace_origin_idx, trace_str in enumerate(trace_list):
-        trimmed_trace_str = trace_str_to_class_method(trace_str)
-        trace_removed = False
-
-        trimmed_trace_str = trimmed_trace_str.split("$")[0]
-
-        trace_segments = trimmed_trace_str.split(".")
-        for idx, trace_segment in enumerate(trace_segments):
-            if trace_segment.find(" ") >= 0:
-                break
-            elif ".".join(trace_segments[:idx + 1]) in ex_package_set:
-                trace_removed = True
-                break
+    # traces repeat the same methods a lot, check each one only once
+    irrelevant_cache = {}
+    for trace_origin_idx, trace_item in enumerate(trace_list):
+        class_method = class_method_list[trace_origin_idx]
+        trace_removed = irrelevant_cache.get(class_method)
+        if trace_removed is None:
+            trace_removed = class_method_irrelevant(class_method, ex_package_set)
+            irrelevant_cache[class_method] = trace_removed
         if not trace_removed:
-            ret_trace_list.append(trace_str)
+            ret_trace_list.append(trace_item)
             origin_idx_list.append(trace_origin_idx)
 
     return ret_trace_list, origin_idx_list
 
 
-def process_trace(trace_str):
-    trace_lines = trace_str.split(os.linesep)
+def process_trace(trace_dump):
+    # walk the header line by line with offsets, then scan the whole trace
+    # body with a single finditer, so the dump is never split into lines.
+    # The dump is scanned as bytes, only captured fields are decoded
     trace_obj = {}
-
-    idx = 0
-    trace_obj["version"] = int(TRACE_VERSION_RE.match(trace_lines[idx]).groups()[0])
-    idx += 1
-    thread_num = int(TRACE_NUM_RE.match(trace_lines[idx]).groups()[0])
-    idx += 1
-    trace_obj["thread_info"] = {}
+    line_sep = os.linesep.encode(TRACE_ENCODING)
+
+    line_start = 0
+    line_end = trace_dump.find(line_sep, line_start)
+    trace_obj["version"] = int(TRACE_VERSION_RE.match(trace_dump, line_start, line_end).groups()[0])
+    line_start = line_end + len(line_sep)
+    line_end = trace_dump.find(line_sep, line_start)
+    thread_num = int(TRACE_NUM_RE.match(trace_dump, line_start, line_end).groups()[0])
+    line_start = line_end + len(line_sep)
+    thread_names = {}
+    thread_lists = {}
     for i in range(thread_num):
-        thread_name_start_idx = trace_lines[i + idx].find(" ") + 1
-        tid = int(trace_lines[i + idx][:thread_name_start_idx])
-        trace_obj["thread_info"][tid] = {}
-        trace_obj["thread_info"][tid]["name"] = trace_lines[i + idx][thread_name_start_idx:]
-        trace_obj["thread_info"][tid]["trace"] = []
-    idx += thread_num + 1
-
-    while len(trace_lines[idx]):
-        line_info = TRACE_ITEM_RE.match(trace_lines[idx]).groups()
-        trace_obj["thread_info"][int(line_info[0])]["trace"].append(
-            "%s%s %s %s %s" % (line_info[1], line_info[2], line_info[4], line_info[5], line_info[6])
-        )
-        idx += 1
-    # get rid of empty traces
-    tids = trace_obj["thread_info"].keys()
-    for tid in tids:
-        if not len(trace_obj["thread_info"][tid]["trace"]):
-            trace_obj["thread_info"].pop(tid)
+        line_end = trace_dump.find(line_sep, line_start)
+        tid_str, _, thread_name = trace_dump[line_start:line_end].partition(b" ")
+        tid = int(tid_str)
+        thread_names[tid] = decode_trace_field(thread_name)
+        thread_lists[tid] = ([], [])
+        line_start = line_end + len(line_sep)
+    line_start = trace_dump.find(line_sep, line_start) + len(line_sep)
+
+    # trace items end at the first empty line
+    body_end = trace_dump.find(line_sep * 2, line_start - len(line_sep))
+    if body_end < 0:
+        body_end = len(trace_dump)
+
+    # traces are kept as tuples of their raw fields and only formatted into
+    # strings for output, class methods are stored alongside them so that
+    # comparisons never need to extract them again. This is the hot loop,
+    # so groups are unpacked, int is bound to a local, repeated trace items
+    # share one tuple and each distinct class method is decoded only once
+    to_int = int
+    trace_items = {}
+    class_method_strs = {}
+    for trace_item in TRACE_ITEM_RE.finditer(trace_dump, line_start, body_end):
+        tid, action, mark, _, depth, method, signature, source = trace_item.groups()
+        thread_trace, thread_class_method = thread_lists[to_int(tid)]
+        fields = (action, mark, depth, method, signature, source)
+        thread_trace.append(trace_items.setdefault(fields, fields))
+        class_method = b" ".join((method, signature, source))
+        class_method_str = class_method_strs.get(class_method)
+        if class_method_str is None:
+            class_method_str = class_method_strs[class_method] = decode_trace_field(class_method)
+        thread_class_method.append(class_method_str)
+
+    # threads are returned as parallel lists of tids, names, traces and
+    # class methods sorted by tid, getting rid of empty traces
+    trace_obj["tids"] = sorted([x for x in thread_lists if thread_lists[x][0]])
+    trace_obj["names"] = [thread_names[x] for x in trace_obj["tids"]]
+    trace_obj["traces"] = [thread_lists[x][0] for x in trace_obj["tids"]]
+    trace_obj["class_methods"] = [thread_lists[x][1] for x in trace_obj["tids"]]
     return trace_obj
 
 
-def trace_similarity(name_a, trace_a, name_b, trace_b):
-    # cov similarity and name similarity
+def process_trace_dump(dump_file):
+    # process dmtracedump output through a read-only mapping of its file
+    with mmap.mmap(dump_file.fileno(), 0, access=mmap.ACCESS_READ) as dump_map:
+        return process_trace(dump_map)
+
+
+def name_similarity_matrix(names_a, names_b):
+    # name similarity of all thread pairs: 1.0 for equal names, 0.5 for names
+    # with a common prefix, 0.0 otherwise. Only the whole names and their
+    # first characters need comparing, so no common prefix is computed
+    names_a = numpy.array(names_a, dtype=object)
+    names_b = numpy.array(names_b, dtype=object)
+    initials_a = numpy.array([x[:1] for x in names_a], dtype=object)
+    initials_b = numpy.array([x[:1] for x in names_b], dtype=object)
+    name_equal = names_a[:, None] == names_b[None, :]
+    initial_equal = (initials_a[:, None] == initials_b[None, :]) & (initials_a != "")[:, None]
+    return numpy.where(name_equal, 1.0, numpy.where(initial_equal, 0.5, 0.0)).astype(numpy.float32)
+
+
+def class_method_matrix(class_methods_list, class_method_ids):
+    # sparse thread x class method incidence matrix, class_method_ids maps
+    # class methods to columns and is shared by both sides of a comparison
+    indices = []
+    indptr = [0]
+    for class_methods in class_methods_list:
+        indices.extend([class_method_ids.setdefault(x, len(class_method_ids)) for x in class_methods])
+        indptr.append(len(indices))
+    return (numpy.ones(len(indices), dtype=numpy.int32), indices, indptr)
+
+
+def trace_similarity_matrix(class_methods_list_a, class_methods_list_b):
+    # cov similarity of all thread pairs, combined with
+    # name_similarity_matrix by compare_trace
     # TODO: sensitive API (PScout) call pattern
     # (combined with diverge history and UI difference to judge whether anti-sandbox)
     # (malware may not have any UI)
     # TODO: iteratively remove diverge common prefix from traces
 
-    class_methods_a = set()
-    class_methods_b = set()
-    for trace_str in trace_a:
-        class_methods_a.add(trace_str_to_class_method(trace_str))
-    for trace_str in trace_b:
-        class_methods_b.add(trace_str_to_class_method(trace_str))
-
-    name_sim = float(len(os.path.commonprefix([name_a, name_b]))) / max(len(name_a), len(name_b))
-    if 0.0 < name_sim < 1.0:
-        name_sim = 0.5
-    cov_sim = float(len(class_methods_a & class_methods_b)) / (len(class_methods_a | class_methods_b))
-    return name_sim * cov_sim
-
-
-def compare_trace(real_device_trace_path, emulator_trace_path, output_file_path, ex_package_set):
+    # the intersection sizes of all pairs of class method sets are a single
+    # sparse product of the incidence matrices of both sides
+    class_method_ids = {}
+    csr_a = class_method_matrix(class_methods_list_a, class_method_ids)
+    csr_b = class_method_matrix(class_methods_list_b, class_method_ids)
+    matrix_a = scipy.sparse.csr_matrix(csr_a, shape=(len(class_methods_list_a), len(class_method_ids)))
+    matrix_b = scipy.sparse.csr_matrix(csr_b, shape=(len(class_methods_list_b), len(class_method_ids)))
+
+    common_num = (matrix_a * matrix_b.T).toarray()
+    size_a = numpy.array([len(x) for x in class_methods_list_a])
+    size_b = numpy.array([len(x) for x in class_methods_list_b])
+    return common_num.astype(numpy.float32) / (size_a[:, None] + size_b[None, :] - common_num).astype(numpy.float32)
+
+
+def solve_dense_assignment(cost_matrix):
+    # minimum cost assignment, returns (row_idx, col_idx) like
+    # scipy.optimize.linear_sum_assignment
+    row_num, col_num = cost_matrix.shape
+    if row_num == 1:
+        return numpy.array([0]), numpy.array([numpy.argmin(cost_matrix[0])])
+    if col_num == 1:
+        return numpy.array([numpy.argmin(cost_matrix[:, 0])]), numpy.array([0])
+    if lap is None or max(row_num, col_num) < LAPJV_MIN_SIZE:
+        return scipy.optimize.linear_sum_assignment(cost_matrix)
+    row_to_col = lap.lapjv(cost_matrix, extend_cost=True)[1]
+    row_idx = numpy.nonzero(row_to_col >= 0)[0]
+    return row_idx, row_to_col[row_idx]
+
+
+def solve_assignment(cost_matrix):
+    # minimum cost assignment of a similarity cost matrix (costs <= 0)
+    # pairs with zero cost never improve the assignment, so each connected
+    # component of negative costs is solved on its own, then the rows and
+    # columns left over are paired up at zero cost
+    row_num, col_num = cost_matrix.shape
+    if not row_num or not col_num:
+        return numpy.array([], dtype=int), numpy.array([], dtype=int)
+    if row_num == 1 or col_num == 1:
+        return solve_dense_assignment(cost_matrix)
+
+    link_matrix = scipy.sparse.csr_matrix(cost_matrix < 0)
+    component_num, labels = scipy.sparse.csgraph.connected_components(
+        scipy.sparse.bmat([[None, link_matrix], [link_matrix.T, None]]), directed=False)
+    row_labels = labels[:row_num]
+    col_labels = labels[row_num:]
+
+    row_idx_list = []
+    col_idx_list = []
+    for component in range(component_num):
+        component_rows = numpy.nonzero(row_labels == component)[0]
+        component_cols = numpy.nonzero(col_labels == component)[0]
+        if not len(component_rows) or not len(component_cols):
+            continue
+        sub_row_idx, sub_col_idx = solve_dense_assignment(cost_matrix[numpy.ix_(component_rows, component_cols)])
+        row_idx_list.extend(component_rows[sub_row_idx])
+        col_idx_list.extend(component_cols[sub_col_idx])
+
+    rows_left = sorted(set(range(row_num)) - set(row_idx_list))
+    cols_left = sorted(set(range(col_num)) - set(col_idx_list))
+    for x, y in zip(rows_left, cols_left):
+        row_idx_list.append(x)
+        col_idx_list.append(y)
+
+    order = numpy.argsort(row_idx_list)
+    return numpy.array(row_idx_list, dtype=int)[order], numpy.array(col_idx_list, dtype=int)[order]
+
+
+def compare_trace(real_device_trace_path, emulator_trace_path, output_file_path, ex_package_set, sim_cutoff):
     # There might be various kinds of differences between real/emu threads
     # including
     # 1. different triggered threads
@@ -120,42 +266,56 @@ def compare_trace(real_device_trace_path, emulator_trace_path, output_file_path,
     # 2. filter out some irrelevant methods (now using)
     # 3. automatically generate irrelevant methods by repeating dynamic tests
 
-    p1 = subprocess.Popen(["dmtracedump", "-o", real_device_trace_path], stdout=subprocess.PIPE)
-    p2 = subprocess.Popen(["dmtracedump", "-o", emulator_trace_path], stdout=subprocess.PIPE)
-    real_device_trace_str = p1.communicate()[0]
-    emulator_trace_str = p2.communicate()[0]
-    if p1.returncode != 0 or p2.returncode != 0:
-        return "%s failed" % output_file_path
-
-    real_device_trace_obj = process_trace(real_device_trace_str)
-    emulator_trace_obj = process_trace(emulator_trace_str)
+    # dump into temp files instead of pipes, so that both dmtracedump's run
+    # to completion concurrently instead of stalling on a full pipe
+    with tempfile.TemporaryFile() as real_device_dump, tempfile.TemporaryFile() as emulator_dump:
+        p1 = subprocess.Popen(["dmtracedump", "-o", real_device_trace_path], stdout=real_device_dump)
+        p2 = subprocess.Popen(["dmtracedump", "-o", emulator_trace_path], stdout=emulator_dump)
+        # parse the real device dump while the emulator one is still being
+        # written, and give up on the emulator dump if the first one failed
+        if p1.wait() != 0:
+            p2.kill()
+            p2.wait()
+            return "%s failed" % output_file_path
+        try:
+            real_device_trace_obj = process_trace_dump(real_device_dump)
+        except Exception:
+            p2.kill()
+            p2.wait()
+            raise
+        if p2.wait() != 0:
+            return "%s failed" % output_file_path
+        emulator_trace_obj = process_trace_dump(emulator_dump)
 
     # Kuhn-Munkres algorithm for maximum similarity
-    r_tid_list = sorted(real_device_trace_obj["thread_info"].keys())
-    e_tid_list = sorted(emulator_trace_obj["thread_info"].keys())
-    sim_matrix = numpy.zeros([len(r_tid_list), len(e_tid_list)])
-    for i, tid_r in enumerate(r_tid_list):
-        for j, tid_e in enumerate(e_tid_list):
-            sim_matrix[i][j] = -trace_similarity(
-                real_device_trace_obj["thread_info"][tid_r]["name"],
-                real_device_trace_obj["thread_info"][tid_r]["trace"],
-                emulator_trace_obj["thread_info"][tid_e]["name"],
-                emulator_trace_obj["thread_info"][tid_e]["trace"]
-            )
-    r_idx, e_idx = scipy.optimize.linear_sum_assignment(sim_matrix)
+    r_tid_list = real_device_trace_obj["tids"]
+    e_tid_list = emulator_trace_obj["tids"]
+    r_names = real_device_trace_obj["names"]
+    e_names = emulator_trace_obj["names"]
+    r_traces = real_device_trace_obj["traces"]
+    e_traces = emulator_trace_obj["traces"]
+    r_class_methods = real_device_trace_obj["class_methods"]
+    e_class_methods = emulator_trace_obj["class_methods"]
+    # sim_matrix is assembled serially: it is a few numpy broadcasts and one
+    # sparse product, and run() already keeps one process per core busy
+    # float32 is plenty for similarities, which only rank thread pairs
+    sim_matrix = -name_similarity_matrix(r_names, e_names) * \
+        trace_similarity_matrix([frozenset(x) for x in r_class_methods], [frozenset(x) for x in e_class_methods])
+    # similarities below sim_cutoff are treated as none at all, which splits
+    # the assignment into more and smaller components
+    r_idx, e_idx = solve_assignment(numpy.where(sim_matrix < -sim_cutoff, sim_matrix, 0))
     trace_similarity_list = []
 
     unmatched_threads = {"real_device": [], "emulator": []}
+    r_matched = set()
+    e_matched = set()
     for x, y in zip(r_idx, e_idx):
-        real_device_thread = real_device_trace_obj["thread_info"][r_tid_list[x]]
-        emulator_thread = emulator_trace_obj["thread_info"][e_tid_list[y]]
-
         #if -sim_matrix[x][y] < 0.01:
         #    continue
 
         # divergence point finding
-        real_device_trace, real_idx = clean_trace(real_device_thread["trace"], ex_package_set)
-        emulator_trace, emu_idx = clean_trace(emulator_thread["trace"], ex_package_set)
+        real_device_trace, real_idx = clean_trace(r_traces[x], r_class_methods[x], ex_package_set)
+        emulator_trace, emu_idx = clean_trace(e_traces[y], e_class_methods[y], ex_package_set)
 
         trace_aligned = len(real_device_trace) == 0 or \
                         len(emulator_trace) == 0 or \
@@ -170,12 +330,14 @@ def compare_trace(real_device_trace_path, emulator_trace_path, output_file_path,
                     trace_idx += 1
             trace_similarity_info = {
                 "real_id": r_tid_list[x],
-                "real_name": real_device_thread["name"],
-                "real_trace": real_device_trace[max(0, trace_idx - 1):trace_idx + 1] if trace_idx < max_common_len else None,
+                "real_name": r_names[x],
+                "real_trace": [trace_item_to_str(z) for z in real_device_trace[max(0, trace_idx - 1):trace_idx + 1]]
+                              if trace_idx < max_common_len else None,
                 "emu_id": e_tid_list[y],
-                "emu_name": emulator_thread["name"],
-                "emu_trace": emulator_trace[max(0, trace_idx - 1):trace_idx + 1] if trace_idx < max_common_len else None,
-                "sim_cov": -sim_matrix[x][y],
+                "emu_name": e_names[y],
+                "emu_trace": [trace_item_to_str(z) for z in emulator_trace[max(0, trace_idx - 1):trace_idx + 1]]
+                             if trace_idx < max_common_len else None,
+                "sim_cov": round(float(-sim_matrix[x][y]), 6),
                 "max_common_len": max_common_len,
                 "diverge_idx": trace_idx,
                 "sim_max_common": float(trace_idx) / max_common_len if max_common_len else 1.0,
@@ -186,46 +348,96 @@ def compare_trace(real_device_trace_path, emulator_trace_path, output_file_path,
             # api finding
             # method calls before the divering custom method
             if trace_similarity_info["real_trace"] is not None:
-                real_api_list = real_device_thread["trace"][:real_idx[trace_idx]]
+                real_api_list = r_class_methods[x][:real_idx[trace_idx]]
                 # TODO: provide selected apis for trace monitor
-                trace_similarity_info["real_api"] = sorted(list(set([trace_str_to_class_method(x) for x in real_api_list])))
+                trace_similarity_info["real_api"] = sorted(list(set(real_api_list)))
 
             if trace_similarity_info["emu_trace"] is not None:
-                emu_api_list = emulator_thread["trace"][:emu_idx[trace_idx]]
+                emu_api_list = e_class_methods[y][:emu_idx[trace_idx]]
                 # TODO: provide selected apis for trace monitor
-                trace_similarity_info["emu_api"] = sorted(list(set([trace_str_to_class_method(x) for x in emu_api_list])))
+                trace_similarity_info["emu_api"] = sorted(list(set(emu_api_list)))
 
             trace_similarity_list.append(trace_similarity_info)
+            r_matched.add(x)
+            e_matched.add(y)
 
     # collect threads not chosen
-    for (tid, tname) in [(x, real_device_trace_obj["thread_info"][x]["name"]) for x in
-                         set(r_tid_list) - set([y["real_id"] for y in trace_similarity_list])]:
-        unmatched_threads["real_device"].append({
-            "id": tid,
-            "name": tname,
-            # TODO: provide selected apis for trace monitor
-            "api": sorted(list(set([trace_str_to_class_method(x)
-                                    for x in real_device_trace_obj["thread_info"][tid]["trace"]])))
-        })
-    for (tid, tname) in [(x, emulator_trace_obj["thread_info"][x]["name"]) for x in
-                         set(e_tid_list) - set([y["emu_id"] for y in trace_similarity_list])]:
-        unmatched_threads["emulator"].append({
-            "id": tid,
-            "name": tname,
-            # TODO: provide selected apis for trace monitor
-            "api": sorted(list(set([trace_str_to_class_method(x)
-                                    for x in emulator_trace_obj["thread_info"][tid]["trace"]])))
-        })
-
-    with open(output_file_path, "w") as output_file:
-        output_file.write(json.dumps({
-            "matched_threads": trace_similarity_list,
-            "unmatched_threads": unmatched_threads
-        }, indent=2))
+    for x in range(len(r_tid_list)):
+        if x not in r_matched:
+            unmatched_threads["real_device"].append({
+                "id": r_tid_list[x],
+                "name": r_names[x],
+                # TODO: provide selected apis for trace monitor
+                "api": sorted(list(set(r_class_methods[x])))
+            })
+    for y in range(len(e_tid_list)):
+        if y not in e_matched:
+            unmatched_threads["emulator"].append({
+                "id": e_tid_list[y],
+                "name": e_names[y],
+                # TODO: provide selected apis for trace monitor
+                "api": sorted(list(set(e_class_methods[y])))
+            })
+
+    comparison_result = {
+        "matched_threads": trace_similarity_list,
+        "unmatched_threads": unmatched_threads
+    }
+    if orjson is not None:
+        output_bytes = orjson.dumps(comparison_result, option=orjson.OPT_INDENT_2)
+    else:
+        output_bytes = json.dumps(comparison_result, indent=2).encode(TRACE_ENCODING)
+    # write next to the output and replace it, so a failed write never leaves
+    # a truncated output behind
+    temp_output_path = "%s.%d.tmp" % (output_file_path, os.getpid())
+    try:
+        with open(temp_output_path, "wb") as output_file:
+            output_file.write(output_bytes)
+        os.replace(temp_output_path, output_file_path)
+    except BaseException:
+        if os.path.exists(temp_output_path):
+            os.remove(temp_output_path)
+        raise
 
     return "%s written" % output_file_path
 
 
+def file_md5(file_path):
+    with open(file_path, "rb") as input_file:
+        return hashlib.md5(input_file.read()).hexdigest()
+
+
+def job_inputs(job):
+    # input traces of a comparison job with their mtimes
+    return [[job[0], os.path.getmtime(job[0])], [job[1], os.path.getmtime(job[1])]]
+
+
+def settings_md5(ex_package_set, sim_cutoff):
+    # digest of the settings a comparison's output depends on besides its traces
+    return hashlib.md5(json.dumps([sorted(ex_package_set), sim_cutoff]).encode("utf-8")).hexdigest()
+
+
+def load_cache_manifest(cache_manifest_path):
+    # an unreadable manifest is treated as empty, all pairs are compared again
+    try:
+        with open(cache_manifest_path, "r") as cache_manifest_file:
+            cache_manifest = json.load(cache_manifest_file)
+    except (IOError, ValueError):
+        return {}
+    return cache_manifest if isinstance(cache_manifest, dict) else {}
+
+
+def job_cached(job, cache_manifest, job_settings_md5):
+    # whether the job's output is recorded in the cache manifest with
+    # unchanged inputs and settings, and is still the output written back then
+    cache_entry = cache_manifest.get(job[2])
+    return isinstance(cache_entry, dict) and \
+        os.path.exists(job[2]) and \
+        cache_entry.get("settings_md5") == job_settings_md5 and \
+        cache_entry.get("inputs") == job_inputs(job) and \
+        cache_entry.get("output_md5") == file_md5(job[2])
+
+
 def get_irrelevant_packages(irrelevant_packages):
     package_set = set()
 
@@ -262,50 +474,76 @@ def run(config_json_path):
     emulator_droidbot_out_dir = os.path.abspath(config_json["emulator_droidbot_out_dir"])
     output_dir = os.path.abspath(config_json["output_dir"])
     if os.system("mkdir -p %s" % output_dir):
-        print "failed mkdir -p %s" % output_dir
+        print("failed mkdir -p %s" % output_dir)
         return
     process_num = config_json["process_num"]
+    sim_cutoff = config_json.get("sim_cutoff", 0.0)
 
-    real_device_apps = [x for x in os.walk(real_device_droidbot_out_dir).next()[1]]
-    emulator_apps = [x for x in os.walk(emulator_droidbot_out_dir).next()[1]]
+    real_device_apps = [x.name for x in os.scandir(real_device_droidbot_out_dir) if x.is_dir()]
+    emulator_apps = [x.name for x in os.scandir(emulator_droidbot_out_dir) if x.is_dir()]
     both_apps = list(set(real_device_apps) & set(emulator_apps))
 
     # get irrelevant classes
     ex_package_set = get_irrelevant_packages(config_json["irrelevant_packages"])
 
     # generate trace path pairs for comparing
-    pool = Pool(processes=process_num)
-    result_list = []
+    job_list = []
     for app_name in both_apps:
         real_device_path = "%s/%s/events" % (real_device_droidbot_out_dir, app_name)
         emulator_path = "%s/%s/events" % (emulator_droidbot_out_dir, app_name)
 
         try:
-            real_device_traces = sorted([x for x in os.walk(real_device_path).next()[2]
-                                         if x.endswith(".trace")])
-            emulator_traces = sorted([x for x in os.walk(emulator_path).next()[2]
-                                     if x.endswith(".trace")])
+            real_device_traces = sorted([x.name for x in os.scandir(real_device_path)
+                                         if x.is_file() and x.name.endswith(".trace")])
+            emulator_traces = sorted([x.name for x in os.scandir(emulator_path)
+                                     if x.is_file() and x.name.endswith(".trace")])
 
             for x, y in zip(real_device_traces, emulator_traces):
                 x_tag = x[len("event_trace_"):-len(".trace")]
                 y_tag = y[len("event_trace_"):-len(".trace")]
-                async_result = pool.apply_async(compare_trace,
-                                                ["%s/%s" % (real_device_path, x),
-                                                 "%s/%s" % (emulator_path, y),
-                                                 "%s/%s_%s_%s.json" % (output_dir, app_name, x_tag, y_tag),
-                                                 ex_package_set])
-                result_list.append(async_result)
+                job_list.append(("%s/%s" % (real_device_path, x),
+                                 "%s/%s" % (emulator_path, y),
+                                 "%s/%s_%s_%s.json" % (output_dir, app_name, x_tag, y_tag),
+                                 ex_package_set,
+                                 sim_cutoff))
         except Exception as e:
-            print e
-
-    for async_result in result_list:
-        try:
-            print async_result.get()
-        except Exception as e:
-            print e
-
-    pool.close()
-    pool.join()
+            print(e)
+
+    # skip trace pairs compared before with unchanged inputs and settings
+    cache_manifest_path = "%s/.cache_manifest.json" % output_dir
+    cache_manifest = load_cache_manifest(cache_manifest_path)
+    job_settings_md5 = settings_md5(ex_package_set, sim_cutoff)
+    uncached_job_list = []
+    for job in job_list:
+        if job_cached(job, cache_manifest, job_settings_md5):
+            print("%s cached" % job[2])
+        else:
+            uncached_job_list.append(job)
+    job_list = uncached_job_list
+
+    # results are consumed in completion order while other jobs keep running,
+    # only jobs that succeeded are recorded in the manifest
+    succeeded_jobs = []
+    with ProcessPoolExecutor(max_workers=process_num) as executor:
+        future_jobs = dict([(executor.submit(compare_trace, *x), x) for x in job_list])
+        for future in as_completed(future_jobs):
+            # one failing job should not stop the others
+            try:
+                print(future.result())
+                succeeded_jobs.append(future_jobs[future])
+            except Exception as e:
+                print("%s failed: %s" % (future_jobs[future][2], e))
+
+    for job in job_list:
+        cache_manifest.pop(job[2], None)
+    for job in succeeded_jobs:
+        cache_manifest[job[2]] = {
+            "settings_md5": job_settings_md5,
+            "inputs": job_inputs(job),
+            "output_md5": file_md5(job[2])
+        }
+    with open(cache_manifest_path, "w") as cache_manifest_file:
+        cache_manifest_file.write(json.dumps(cache_manifest, indent=2))
 
 
 def parse_args():
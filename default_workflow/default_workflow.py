@@ -22,6 +22,7 @@ TRACE_COLLECTOR_CONFIG_OUTPUT_DIR = "ReDroid_apps_droidbot_out"
 
 # trace_comparator_config.json default items
 TRACE_COMPARATOR_CONFIG_OUTPUT_DIR = "ReDroid_trace_comparator_out"
+TRACE_COMPARATOR_CONFIG_SIM_CUTOFF = 0.0
 
 # trace_monitor_config.json default items
 TRACE_MONITOR_CONFIG_OUTPUT_DIR = os.path.join("ReDroid_dsm", "monitor")
@@ -81,6 +82,7 @@ def run(config_json_path):
         "emulator_droidbot_out_dir": os.path.join(trace_collector_config["output_dir"], emulator_id),
         "output_dir": os.path.join(output_dir, TRACE_COMPARATOR_CONFIG_OUTPUT_DIR),
         "process_num": process_num,
+        "sim_cutoff": TRACE_COMPARATOR_CONFIG_SIM_CUTOFF,
         "irrelevant_packages": {
             "jars": [
                 os.path.join(android_sdk_path, "platforms", "android-24", "android.jar"),
@@ -101,7 +103,7 @@ def run(config_json_path):
     config_file_path = os.path.join(config_dir, "trace_comparator_config.json")
     with open(config_file_path, "w") as config_file:
         json.dump(trace_comparator_config, config_file, indent=2)
-    p = subprocess.Popen(["python", os.path.join(redroid_path, "anti_sandbox_detector", "scripts", "trace_comparator.py"),
+    p = subprocess.Popen(["python3", os.path.join(redroid_path, "anti_sandbox_detector", "scripts", "trace_comparator.py"),
                           "-c", config_file_path])
     p.wait()
 